@@ -7,12 +7,14 @@ Author: Raghav Kansal
 from __future__ import annotations
 
 import argparse
+import json
 import os
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from os import listdir
 from pathlib import Path
 
-import numpy as np
-
 from boostedhh import utils
 from boostedhh.submit_utils import print_red, replace_batch_size
 
@@ -35,18 +37,31 @@ parser.add_argument("--tag", default="", help="tag for jobs", type=str)
 parser.add_argument("--year", help="year", type=str, required=True)
 parser.add_argument("--change-batch-size", help="Change batch size for failed jobs - primarily in case the jobs are failing because of memory issues", type=int, default=None)
 parser.add_argument("--user", default="rkansal", help="user", type=str)
+parser.add_argument(
+    "--max-workers", default=32, help="# of threads for checking samples in parallel", type=int
+)
 utils.add_bool_arg(parser, "submit-missing", default=False, help="submit missing files")
 utils.add_bool_arg(parser, "print-shell", default=False, help="print .sh files as well")
 utils.add_bool_arg(
     parser,
     "check-running",
     default=False,
-    help="check against running jobs as well (running_jobs.txt will be updated automatically)",
+    help="check against running jobs as well (queried from condor_q)",
 )
 
 args = parser.parse_args()
 
 
+def scan(path: str) -> dict[str, os.DirEntry]:
+    """Map of {name: entry} for a directory, using a single ``os.scandir`` call"""
+    with os.scandir(path) as it:
+        return {entry.name: entry for entry in it}
+
+
+def is_dir(entries: dict[str, os.DirEntry], name: str) -> bool:
+    return name in entries and entries[name].is_dir()
+
+
 cmspath = {
     "lpc": "/eos/uscms/",
     "ucsd": "/ceph/cms/",
@@ -56,104 +71,127 @@ xrddir = (
     f"{cmspath}/store/user/{args.user}/{args.analysis}/{args.processor}/{args.tag}/{args.year}/"
 )
 
-samples = listdir(xrddir)
-jdls = [jdl for jdl in listdir(f"condor/{args.processor}/{args.tag}/") if jdl.endswith(".jdl")]
+samples = [name for name, entry in scan(xrddir).items() if entry.is_dir()]
+condor_dir = f"condor/{args.processor}/{args.tag}"
 
-jdl_dict = {}
-for sample in samples:
-    x = [
-        int(jdl[:-4].split("_")[-1])
-        for jdl in jdls
-        if jdl.split("_")[0] == args.year and "_".join(jdl.split("_")[1:-1]) == sample
-    ]
-    if len(x) > 0:
-        jdl_dict[sample] = np.sort(x)[-1] + 1
-
-"""
-jdl_dict = {
-    sample: np.sort(
-        [
-            int(jdl[:-4].split("_")[-1])
-            for jdl in jdls
-            if jdl.split("_")[0] == args.year and "_".join(jdl.split("_")[1:-1]) == sample
-        ]
-    )[-1]
-    + 1
-    for sample in samples
-}
-"""
-
-
-running_jobs = []
-if args.check_running:
-    os.system("condor_q | awk '{print $9}' > running_jobs.txt")
-    with Path("running_jobs.txt").open() as f:
-        lines = f.readlines()
+# job indices per sample, from a single pass over the {year}_{sample}_{index}.jdl files
+jdl_index = defaultdict(list)
+for jdl in listdir(condor_dir):
+    if not jdl.endswith(".jdl"):
+        continue
 
-    running_jobs = [s[:-4] for s in lines if s.endswith(".sh\n")]
+    year, _, rest = jdl[:-4].partition("_")
+    if year != args.year:
+        continue
 
+    sample, _, idx = rest.rpartition("_")
+    jdl_index[sample].append(int(idx))
 
-missing_files = []
-err_files = []
+# number of jobs per sample
+jdl_dict = {sample: max(jdl_index[sample]) + 1 for sample in samples if sample in jdl_index}
 
 
-for sample in samples:
-    print(f"Checking {sample}")
+running_jobs = set()
+if args.check_running:
+    # output files of the user's jobs in the queue are logs/{year}_{sample}_{i}.out
+    condor_q = subprocess.run(
+        ["condor_q", "-nobatch", "-json", "-attributes", "Out"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # condor_q leaves out missing attributes, so jobs without an output file are skipped
+    running_jobs = {
+        Path(ad["Out"]).stem for ad in json.loads(condor_q.stdout or "[]") if ad.get("Out")
+    }
+
+
+def job_files(sample: str, i: int) -> tuple[str, str]:
+    """jdl and err files for job ``i`` of ``sample``"""
+    jdl_file = f"{condor_dir}/{args.year}_{sample}_{i}.jdl"
+    err_file = f"{condor_dir}/logs/{args.year}_{sample}_{i}.err"
+    return jdl_file, err_file
+
+
+def shell_file(jdl_file: str) -> str:
+    """shell script run by a job, from the ``executable`` line of its jdl file.
+
+    This is the {year}_{sample}.sh shared by all of the sample's jobs, or a per-job
+    {year}_{sample}_{i}.sh for jobs submitted before the scripts were shared.
+    """
+    with Path(jdl_file).open() as f:
+        for line in f:
+            key, _, value = line.partition("=")
+            if key.strip() == "executable":
+                return value.strip()
+
+    per_job_sh = jdl_file.replace(".jdl", ".sh")
+    return per_job_sh if Path(per_job_sh).exists() else f"{jdl_file.rpartition('_')[0]}.sh"
+
+
+def check_sample(sample: str) -> tuple[list[str], list[str], list[tuple]]:
+    """Check the outputs of all jobs for ``sample``.
+
+    Returns the missing jobs' jdl files, their err files, and the messages to print as a list of
+    (print function, message) tuples, so that samples can be checked in parallel.
+    """
+    missing_files = []
+    err_files = []
+    messages = [(print, f"Checking {sample}")]
+
+    sample_dir = f"{xrddir}/{sample}"
+    sample_entries = scan(sample_dir)
 
     if args.processor != "trigger":
         # add all files if entire parquet directory is missing
-        if not Path(f"{xrddir}/{sample}/parquet").exists():
-            print_red(f"No parquet directory for {sample}!")
+        if not is_dir(sample_entries, "parquet"):
+            messages.append((print_red, f"No parquet directory for {sample}!"))
             if sample not in jdl_dict:
-                continue
+                return missing_files, err_files, messages
 
             for i in range(jdl_dict[sample]):
                 if f"{args.year}_{sample}_{i}" in running_jobs:
-                    print(f"Job #{i} for sample {sample} is running.")
+                    messages.append((print, f"Job #{i} for sample {sample} is running."))
                     continue
 
-                jdl_file = f"condor/{args.processor}/{args.tag}/{args.year}_{sample}_{i}.jdl"
-                err_file = f"condor/{args.processor}/{args.tag}/logs/{args.year}_{sample}_{i}.err"
-                print(jdl_file)
+                jdl_file, err_file = job_files(sample, i)
+                messages.append((print, jdl_file))
                 missing_files.append(jdl_file)
                 err_files.append(err_file)
-                if args.submit_missing:
-                    os.system(f"condor_submit {jdl_file}")
-
-            continue
 
-        num_batches = [f for f in listdir(f"{xrddir}/{sample}/jobchecks") if "num_batches" in f]
+            return missing_files, err_files, messages
 
         expected_parquets = {}
-        for f in num_batches:
-            with Path(f"{xrddir}/{sample}/jobchecks/{f}").open() as file:
-                bnum = file.readlines()
+        with os.scandir(f"{sample_dir}/jobchecks") as it:
+            for entry in it:
+                if not entry.name.startswith("num_batches"):
+                    continue
 
-            fnum = int(f.split("_")[2].split(".")[0])  # remove .txt
-            expected_parquets[fnum] = int(bnum[0])
+                with Path(entry.path).open() as file:
+                    bnum = file.readlines()
 
-        outs_parquet = {}
-        for out in listdir(f"{xrddir}/{sample}/parquet"):
-            fnum = int(out.split("_")[1])
-            if fnum not in outs_parquet:
-                outs_parquet[fnum] = []
+                fnum = int(entry.name.rpartition("_")[2].partition(".")[0])  # remove .txt
+                expected_parquets[fnum] = int(bnum[0])
 
-            bnum = int(out.split("_")[3].split(".")[0])  # remove .parquet
-            outs_parquet[fnum].append(bnum)
+        # out_{fnum}_batch_{bnum}.parquet
+        outs_parquet = {}
+        for out in listdir(f"{sample_dir}/parquet"):
+            parts = out.split("_")
+            bnum = int(parts[3].split(".")[0])  # remove .parquet
+            outs_parquet.setdefault(int(parts[1]), []).append(bnum)
 
         pouts_parquet = [f"{fnum}-{list(bnum)[-1]}" for fnum, bnum in outs_parquet.items()]
-        print(f"Out parquets: {pouts_parquet}")
+        messages.append((print, f"Out parquets: {pouts_parquet}"))
 
-    if not Path(f"{xrddir}/{sample}/pickles").exists():
-        print_red(f"No pickles directory for {sample}!")
-        continue
+    if not is_dir(sample_entries, "pickles"):
+        messages.append((print_red, f"No pickles directory for {sample}!"))
+        return missing_files, err_files, messages
 
-    outs_pickles = [
-        int(out.split(".")[0].split("_")[-1]) for out in listdir(f"{xrddir}/{sample}/pickles")
-    ]
+    with os.scandir(f"{sample_dir}/pickles") as it:
+        outs_pickles = {int(entry.name.split(".")[0].rsplit("_", 1)[1]) for entry in it}
 
     if args.processor == "trigger":
-        print(f"Out pickles: {outs_pickles}")
+        messages.append((print, f"Out pickles: {sorted(outs_pickles)}"))
 
     for i in range(jdl_dict[sample]):
         check_pickles = i in outs_pickles
@@ -162,47 +200,72 @@ for sample in samples:
             if i not in outs_parquet:
                 check_parquet = False
             else:
-                missing_batches = [
-                    j for j in range(expected_parquets[i]) if j not in outs_parquet[i]
-                ]
+                batches = set(outs_parquet[i])
+                missing_batches = [j for j in range(expected_parquets[i]) if j not in batches]
                 check_parquet = len(missing_batches) == 0
 
         if not check_pickles or not check_parquet:
             if f"{args.year}_{sample}_{i}" in running_jobs:
-                print(f"Job #{i} for sample {sample} is running.")
+                messages.append((print, f"Job #{i} for sample {sample} is running."))
                 continue
 
             if not check_pickles:
-                print_red(f"Missing output pickle #{i} for sample {sample}")
+                messages.append((print_red, f"Missing output pickle #{i} for sample {sample}"))
 
             if not check_parquet:
                 if i not in outs_parquet:
-                    print_red(f"Missing all output parquets for job #{i} for sample {sample}")
+                    messages.append(
+                        (print_red, f"Missing all output parquets for job #{i} for sample {sample}")
+                    )
                 else:
-                    print_red(f"Missing batches {missing_batches} for job #{i} for sample {sample}")
-
-            jdl_file = f"condor/{args.processor}/{args.tag}/{args.year}_{sample}_{i}.jdl"
-            err_file = f"condor/{args.processor}/{args.tag}/logs/{args.year}_{sample}_{i}.err"
+                    messages.append(
+                        (
+                            print_red,
+                            f"Missing batches {missing_batches} for job #{i} for sample {sample}",
+                        )
+                    )
+
+            jdl_file, err_file = job_files(sample, i)
             missing_files.append(jdl_file)
             err_files.append(err_file)
-            if args.submit_missing:
-                os.system(f"condor_submit {jdl_file}")
+
+    return missing_files, err_files, messages
+
+
+missing_files = []
+err_files = []
+
+# samples are checked in parallel (dominated by filesystem latency), but printed in order
+with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+    for smissing_files, serr_files, messages in executor.map(check_sample, samples):
+        for printer, message in messages:
+            printer(message)
+
+        missing_files += smissing_files
+        err_files += serr_files
+
+if args.submit_missing:
+    for jdl_file in missing_files:
+        subprocess.run(["condor_submit", jdl_file], check=False)
 
 
 print(f"{len(missing_files)} files to re-run:")
 for f in missing_files:
     print(f)
 
+# shell scripts can be shared by all jobs of a sample, so list each only once
+missing_shells = list(dict.fromkeys(shell_file(f) for f in missing_files))
+
 if args.print_shell:
-    print(f"\n{len(missing_files)} bash files:")
-    for f in missing_files:
-        print(f.replace(".jdl", ".sh"))
+    print(f"\n{len(missing_shells)} bash files:")
+    for f in missing_shells:
+        print(f)
 
 if args.change_batch_size is not None:
     print(f"\nChanging the batch size to {args.change_batch_size} in the following files:")
 
-    for f in missing_files:
-        shfile = Path(f.replace(".jdl", ".sh"))
+    for f in missing_shells:
+        shfile = Path(f)
         print(shfile)
         replace_batch_size(shfile, args.change_batch_size)
     
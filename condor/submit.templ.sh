@@ -1,5 +1,10 @@
 #!/bin/bash
 
+# job number and range of files to process, passed as arguments from the job's jdl
+jobnum=$$1
+starti=$$2
+endi=$$3
+
 # make sure this is installed
 # python3 -m pip install correctionlib==2.0.0rc6
 # pip install --upgrade numpy==1.21.5
@@ -36,7 +41,7 @@ echo "https://github.com/$gituser/$repo/commit/$${commithash}" > commithash.txt
 #move output to t2s
 for t2_prefix in ${t2_prefixes}
 do
-    xrdcp -f commithash.txt $${t2_prefix}/${outdir}/jobchecks/commithash_${jobnum}.txt
+    xrdcp -f commithash.txt $${t2_prefix}/${outdir}/jobchecks/commithash_$${jobnum}.txt
 done
 
 pip install -e .
@@ -46,13 +51,13 @@ cd ..
 
 # run code
 # pip install --user onnxruntime
-python -u -W ignore $script --year $year --starti $starti --endi $endi --batch-size ${batch_size} --file-tag $filetag --samples $sample --subsamples $subsample --processor $processor --maxchunks $maxchunks --chunksize $chunksize ${save_root} ${save_systematics} --nano-version ${nano_version} $processor_args
+python -u -W ignore $script --year $year --starti $${starti} --endi $${endi} --batch-size ${batch_size} --file-tag $${jobnum} --samples $sample --subsamples $subsample --processor $processor --maxchunks $maxchunks --chunksize $chunksize ${save_root} ${save_systematics} --nano-version ${nano_version} $processor_args
 
 #move output to t2s
 for t2_prefix in ${t2_prefixes}
 do
     xrdcp -f num_batches*.txt "$${t2_prefix}/${outdir}/jobchecks/"
-    xrdcp -f outfiles/* "$${t2_prefix}/${outdir}/pickles/out_${jobnum}.pkl"
+    xrdcp -f outfiles/* "$${t2_prefix}/${outdir}/pickles/out_$${jobnum}.pkl"
     xrdcp -f *.parquet "$${t2_prefix}/${outdir}/parquet/"
     xrdcp -f *.root "$${t2_prefix}/${outdir}/root/"
 done
@@ -8,10 +8,15 @@ from __future__ import annotations
 
 import argparse
 import json
+import threading
 import warnings
+from collections import deque
+from functools import partial
 from pathlib import Path
+from typing import NamedTuple
 
 from XRootD import client
+from XRootD.client.flags import DirListFlags, StatInfoFlags
 
 from boostedhh import hh_vars, utils
 
@@ -24,6 +29,139 @@ def _dirlist(fs, path) -> list:
     return [f.name for f in listing]
 
 
+def _is_dir(entry) -> bool:
+    """Whether a ``DirListFlags.STAT`` listing entry is a directory (assumed so if no stat info)"""
+    return entry.statinfo is None or bool(entry.statinfo.flags & StatInfoFlags.IS_DIR)
+
+
+class _Entry(NamedTuple):
+    """Entry of a directory listing split out of a recursive listing"""
+
+    name: str
+    statinfo: object
+
+
+class XRDReactor:
+    """Lists XRootD directories asynchronously, keeping up to ``max_inflight`` dirlist requests in
+    flight at once.
+
+    Paths are queued with ``submit(path, depth)``; when the listing of a path queued with
+    ``depth > 0`` completes, each of its subdirectories is queued in turn with ``depth - 1``.
+    ``run()`` drains the queue and returns a dict of {path: list of entries in the directory} for
+    every path listed. Directories are listed with ``DirListFlags.STAT``, so each entry's
+    ``statinfo`` (type, size) comes with the listing without a separate stat request.
+
+    If ``recursive``, paths with ``depth > 0`` are instead listed with a single
+    ``DirListFlags.RECURSIVE`` request for the whole subtree. If such a request fails (e.g. the
+    server does not support it), recursive listings are turned off and the path is re-queued to
+    be listed level by level.
+    """
+
+    def __init__(self, fs, max_inflight: int = 64, recursive: bool = True):
+        self.fs = fs
+        self.recursive = recursive
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._inflight = 0
+        self._listings = {}
+        self._errors = []
+
+    def submit(self, path: str, depth: int = 0):
+        with self._cond:
+            self._queue.append((str(path), depth))
+
+    def _done(self):
+        """Mark a request as completed; must be called with ``self._cond`` held"""
+        self._inflight -= 1
+        self._cond.notify()
+        self._slots.release()
+
+    def _on_complete(self, path: str, depth: int, status, listing, _hostlist=None):
+        with self._cond:
+            if status.ok:
+                entries = list(listing)
+                self._listings[path] = entries
+                if depth > 0:
+                    self._queue.extend(
+                        (f"{path}/{entry.name}", depth - 1) for entry in entries if _is_dir(entry)
+                    )
+            else:
+                self._errors.append(f"{path}: {status}")
+
+            self._done()
+
+    def _on_complete_recursive(self, path: str, depth: int, status, listing, _hostlist=None):
+        with self._cond:
+            if status.ok:
+                # entry names are relative to ``path``: split them into per-directory listings
+                self._listings.setdefault(path, [])
+                for entry in listing:
+                    parent, _, name = entry.name.rpartition("/")
+                    ppath = f"{path}/{parent}" if parent else path
+                    self._listings.setdefault(ppath, []).append(_Entry(name, entry.statinfo))
+                    if _is_dir(entry):
+                        self._listings.setdefault(f"{path}/{entry.name}", [])
+            else:
+                warnings.warn(
+                    f"Recursive listing of {path} failed ({status}), listing level by level",
+                    stacklevel=2,
+                )
+                self.recursive = False
+                self._queue.append((path, depth))
+
+            self._done()
+
+    def run(self) -> dict[str, list]:
+        while True:
+            with self._cond:
+                while not len(self._queue) and self._inflight:
+                    self._cond.wait()
+
+                if not len(self._queue):
+                    break
+
+                path, depth = self._queue.popleft()
+                recursive = self.recursive and depth > 0
+                self._inflight += 1
+
+            if recursive:
+                flags = DirListFlags.STAT | DirListFlags.RECURSIVE
+                callback = partial(self._on_complete_recursive, path, depth)
+            else:
+                flags = DirListFlags.STAT
+                callback = partial(self._on_complete, path, depth)
+
+            self._slots.acquire()
+            status = self.fs.dirlist(path, flags, callback=callback)
+            # callback is not called if the request could not be submitted
+            if not status.ok:
+                callback(status, None)
+
+        listings, self._listings = self._listings, {}
+        errors, self._errors = self._errors, []
+        if len(errors):
+            raise FileNotFoundError(f"Failed to list directories: {errors}")
+
+        return listings
+
+
+def _root_files(listings: dict[str, list], redirector: str, f1path: str) -> list[str]:
+    """.root files under ``f1path / f2 / f3``, using only the last ``f2`` directory."""
+    f2s = [entry.name for entry in listings.get(f1path, []) if _is_dir(entry)]
+    if not len(f2s):
+        return []
+
+    f2path = f"{f1path}/{f2s[-1]}"
+    return [
+        f"{redirector}{f2path}/{f3.name}/{f.name}"
+        for f3 in listings[f2path]
+        if _is_dir(f3)
+        for f in listings[f"{f2path}/{f3.name}"]
+        if f.name.endswith(".root") and not _is_dir(f)
+    ]
+
+
 def xrootd_index_private_nano(
     base_dir: str,
     redirector: str = "root://cmseos.fnal.gov/",
@@ -33,12 +171,22 @@ def xrootd_index_private_nano(
     subsamples: list[str] = None,
     files: dict[str] = None,
     overwrite_sample: bool = False,
+    skip_existing: bool = False,
+    max_inflight: int = 64,
+    recursive_dirlist: bool = True,
 ) -> list:
     """Recursively search for privately produced NanoAOD files via XRootD.
 
     Can specify specific users, years, samples, and subsamples to search for;
     otherwise, it will search for all by default.
 
+    If ``skip_existing``, subsamples already in ``files`` are not re-listed (unless
+    ``overwrite_sample``), so incremental re-indexing only walks new subsamples.
+
+    Directories below each sample are listed asynchronously, with up to ``max_inflight``
+    requests in flight (see ``XRDReactor``). If ``recursive_dirlist``, each f1 directory tree is
+    listed with a single recursive request where the server supports it.
+
     Files are organized as:
 
     MC:
@@ -56,7 +204,8 @@ def xrootd_index_private_nano(
     Tau/Tau_Run2022D/241114_222843/000*/*.root
     """
     fs = client.FileSystem(redirector)
-    base_dir = Path(base_dir)
+    reactor = XRDReactor(fs, max_inflight, recursive_dirlist)
+    base_dir = str(Path(base_dir))
 
     users = _dirlist(fs, base_dir) if users is None else users
     years = hh_vars.years if years is None else years
@@ -71,7 +220,7 @@ def xrootd_index_private_nano(
             if year not in files:
                 files[year] = {}
 
-            ypath = base_dir / user / year
+            ypath = f"{base_dir}/{user}/{year}"
             tsamples = _dirlist(fs, ypath) if samples is None else samples
             for sample in tsamples:
                 if sample not in files[year]:
@@ -81,49 +230,70 @@ def xrootd_index_private_nano(
                     files[year][sample] = {}
 
                 print(f"\t\t\t{sample}")
-                spath = ypath / sample
+                spath = f"{ypath}/{sample}"
 
                 is_data = sample in hh_vars.DATA_SAMPLES
 
                 tsubsamples = _dirlist(fs, spath) if subsamples is None else subsamples
+                sspaths = {}
                 for subsample in tsubsamples:
                     subsample_name = subsample.split("_TuneCP5")[0].split("_LHEweights")[0]
-                    if not is_data:
-                        if subsample_name in files[year][sample]:
-                            warnings.warn(
-                                f"Duplicate subsample found! {subsample_name}", stacklevel=2
-                            )
+                    if not is_data and skip_existing and subsample_name in files[year][sample]:
+                        print(f"\t\t\t\t{subsample_name} already indexed, skipping")
+                        continue
 
-                        print(f"\t\t\t\t{subsample_name}")
+                    sspaths[subsample] = f"{spath}/{subsample}"
+                    reactor.submit(sspaths[subsample])
 
-                    sspath = spath / subsample
-                    for f1 in _dirlist(fs, sspath):
+                # list the f1 directories of all subsamples first,
+                # so that only the needed ones are descended into
+                f1lists = reactor.run()
+
+                f1s = {}
+                for subsample, sspath in sspaths.items():
+                    if is_data:
                         # For Data files, f1 is the subsample name
-                        if is_data:
+                        f1s[subsample] = [
+                            entry.name
+                            for entry in f1lists[sspath]
+                            if _is_dir(entry)
+                            and not (skip_existing and entry.name in files[year][sample])
+                        ]
+                    else:
+                        # only the last f1 directory is used for MC
+                        f1s[subsample] = [
+                            entry.name for entry in f1lists[sspath] if _is_dir(entry)
+                        ][-1:]
+
+                    for f1 in f1s[subsample]:
+                        reactor.submit(f"{sspath}/{f1}", depth=2)
+
+                listings = reactor.run()
+
+                for subsample, sspath in sspaths.items():
+                    if is_data:
+                        for f1 in f1s[subsample]:
                             if f1 in files[year][sample]:
                                 warnings.warn(f"Duplicate subsample found! {f1}", stacklevel=2)
 
                             print(f"\t\t\t\t{f1}")
-
-                        f1path = sspath / f1
-                        for f2 in _dirlist(fs, f1path):
-                            f2path = f1path / f2
-                            tfiles = []
-                            for f3 in _dirlist(fs, f2path):
-                                f3path = f2path / f3
-                                tfiles += [
-                                    f"{redirector}{f3path!s}/{f}"
-                                    for f in _dirlist(fs, f3path)
-                                    if f.endswith(".root")
-                                ]
-
-                        if is_data:
+                            tfiles = _root_files(listings, redirector, f"{sspath}/{f1}")
                             files[year][sample][f1] = tfiles
                             print(f"\t\t\t\t\t{len(tfiles)} files")
+                    else:
+                        subsample_name = subsample.split("_TuneCP5")[0].split("_LHEweights")[0]
+                        if subsample_name in files[year][sample]:
+                            warnings.warn(
+                                f"Duplicate subsample found! {subsample_name}", stacklevel=2
+                            )
 
-                    if not is_data:
-                        files[year][sample][subsample_name] = tfiles
-                        print(f"\t\t\t\t\t{len(tfiles)} files")
+                        print(f"\t\t\t\t{subsample_name}")
+                        if len(f1s[subsample]):
+                            tfiles = _root_files(
+                                listings, redirector, f"{sspath}/{f1s[subsample][0]}"
+                            )
+                            files[year][sample][subsample_name] = tfiles
+                            print(f"\t\t\t\t\t{len(tfiles)} files")
 
     return files
 
@@ -147,6 +317,13 @@ def main():
         parser, "overwrite-sample", "Overwrite an existing sample list in the JSON", default=False
     )
 
+    utils.add_bool_arg(
+        parser,
+        "skip-existing",
+        "Skip (don't re-list) subsamples which already exist in the JSON",
+        default=False,
+    )
+
     parser.add_argument(
         "--redirector",
         type=str,
@@ -154,6 +331,20 @@ def main():
         help="Base XRootD redirector",
     )
 
+    parser.add_argument(
+        "--max-inflight",
+        type=int,
+        default=64,
+        help="Max number of XRootD directory listing requests in flight at once",
+    )
+
+    utils.add_bool_arg(
+        parser,
+        "recursive-dirlist",
+        "List each f1 directory tree with a single recursive XRootD request",
+        default=True,
+    )
+
     parser.add_argument(
         "--base-dir",
         type=str,
@@ -216,6 +407,9 @@ def main():
         args.subsamples,
         files,
         args.overwrite_sample,
+        args.skip_existing,
+        args.max_inflight,
+        args.recursive_dirlist,
     )
 
     # save files per year
@@ -15,8 +15,12 @@ with Path("xsecs.json").open("rb") as f:
 with Path("xsecs_backup.json").open("rb") as f:
     xsecsb = json.load(f)
 
-for k, v in xsecsb.items():
-    if k not in xsecs:
-        print(f"Missing {k}! {v}")
-    elif not np.isclose(xsecs[k], v, rtol=1e-5):
-        print(f"Discrepancy for {k}! {v} vs {xsecs[k]}")
+for k in xsecsb.keys() - xsecs.keys():
+    print(f"Missing {k}! {xsecsb[k]}")
+
+keys = sorted(xsecsb.keys() & xsecs.keys())
+new = np.fromiter((xsecs[k] for k in keys), dtype=np.float64, count=len(keys))
+old = np.fromiter((xsecsb[k] for k in keys), dtype=np.float64, count=len(keys))
+
+for i in np.flatnonzero(~np.isclose(new, old, rtol=1e-5)):
+    print(f"Discrepancy for {keys[i]}! {old[i]} vs {new[i]}")
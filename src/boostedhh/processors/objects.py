@@ -3,28 +3,71 @@
 from __future__ import annotations
 
 import awkward as ak
+import numba
 import numpy as np
 
+# below this many jets the numba kernel's overhead outweighs the fused pass
+JETID_KERNEL_MIN_JETS = 10_000
+
+
+@numba.njit(cache=True)
+def _jetid_v12_kernel(eta, jetId, neHEF, neEmEF, muEF, chEmEF, tight, tightlepveto):
+    for i in range(len(eta)):
+        abseta = abs(eta[i])
+        if (jetId[i] & 2) != 2:
+            passes = False
+        elif abseta <= 2.7:
+            passes = True
+        elif abseta <= 3.0:
+            passes = neHEF[i] >= 0.99
+        else:
+            passes = neEmEF[i] < 0.4
+
+        tight[i] = passes
+        tightlepveto[i] = passes and (abseta > 2.7 or (muEF[i] < 0.8 and chEmEF[i] < 0.8))
+
+
+def _jetid_v12_ak(jets: ak.Array) -> ak.Array:
+    abseta = np.abs(jets.eta)
+    central = abseta <= 2.7
+    forward = abseta > 3.0
+    transition = ~central & ~forward
+
+    jetidtight = ((jets.jetId & 2) == 2) & (
+        central | (transition & (jets.neHEF >= 0.99)) | (forward & (jets.neEmEF < 0.4))
+    )
+
+    jetidtightlepveto = jetidtight & (~central | ((jets.muEF < 0.8) & (jets.chEmEF < 0.8)))
+
+    return jetidtight, jetidtightlepveto
+
 
 def jetid_v12(jets: ak.Array) -> ak.Array:
     """
     Jet ID fix for NanoAOD v12 copying
     # https://gitlab.cern.ch/cms-jetmet/coordination/coordination/-/issues/117#note_8880716
+
+    For large (events x jets) collections both masks are computed in a single numba pass over
+    the flattened jet fields.
     """
+    if jets.ndim != 2:
+        return _jetid_v12_ak(jets)
 
-    jetidtightbit = (jets.jetId & 2) == 2
-    jetidtight = (
-        ((np.abs(jets.eta) <= 2.7) & jetidtightbit)
-        | (
-            ((np.abs(jets.eta) > 2.7) & (np.abs(jets.eta) <= 3.0))
-            & jetidtightbit
-            & (jets.neHEF >= 0.99)
-        )
-        | ((np.abs(jets.eta) > 3.0) & jetidtightbit & (jets.neEmEF < 0.4))
-    )
+    counts = ak.num(jets.eta, axis=1)
+    njets = int(ak.sum(counts))
+    if njets < JETID_KERNEL_MIN_JETS:
+        return _jetid_v12_ak(jets)
 
-    jetidtightlepveto = (
-        (np.abs(jets.eta) <= 2.7) & jetidtight & (jets.muEF < 0.8) & (jets.chEmEF < 0.8)
-    ) | ((np.abs(jets.eta) > 2.7) & jetidtight)
+    fields = [
+        ak.to_numpy(ak.flatten(jets[field]))
+        for field in ["eta", "jetId", "neHEF", "neEmEF", "muEF", "chEmEF"]
+    ]
+    if any(isinstance(field, np.ma.MaskedArray) for field in fields):
+        # option-type (e.g. padded) jets, which the kernel can't handle
+        return _jetid_v12_ak(jets)
 
-    return jetidtight, jetidtightlepveto
+    jetidtight = np.empty(njets, dtype=bool)
+    jetidtightlepveto = np.empty(njets, dtype=bool)
+    _jetid_v12_kernel(*fields, jetidtight, jetidtightlepveto)
+
+    return ak.unflatten(jetidtight, counts), ak.unflatten(jetidtightlepveto, counts)
@@ -2,8 +2,9 @@
 from __future__ import annotations
 
 import json
-import os
 import pickle
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -42,19 +43,14 @@ def get_fileset(
     for sample in samples:
         sample_set = full_fileset_nano[sample]
 
-        set_subsamples = list(sample_set.keys())
-
         # check if any subsamples for this sample have been specified
-        get_subsamples = set(set_subsamples).intersection(subsamples)
-
         if len(subsamples):
-            for subs in subsamples:
-                if subs not in get_subsamples:
-                    raise ValueError(f"Subsample {subs} not found for sample {sample}!")
+            missing = [subs for subs in subsamples if subs not in sample_set]
+            if len(missing):
+                raise ValueError(f"Subsamples {missing} not found for sample {sample}!")
 
-        # if so keep only that subset
-        if len(get_subsamples):
-            sample_set = {subsample: sample_set[subsample] for subsample in get_subsamples}
+            # if so keep only that subset
+            sample_set = {subsample: sample_set[subsample] for subsample in subsamples}
 
         if get_num_files:
             # return only the number of files per subsample (for splitting up jobs)
@@ -70,7 +66,7 @@ def get_fileset(
                 run_fnames = fnames[starti:] if endi < 0 else fnames[starti:endi]
                 sample_fileset[f"{year}_{subsample}"] = run_fnames
 
-            fileset = {**fileset, **sample_fileset}
+            fileset.update(sample_fileset)
 
     return fileset
 
@@ -143,10 +139,12 @@ def flatten_dict(var_dict: dict):
     for key, var in var_dict.items():
         num_objects = var.shape[-1]
         if len(var.shape) >= 2 and num_objects > 1:
-            temp_dict = {f"{key}{obj}": var[:, obj] for obj in range(num_objects)}
-            new_dict = {**new_dict, **temp_dict}
+            # one contiguous column per object, equivalent to var[:, obj]
+            cols = np.ascontiguousarray(np.moveaxis(var, 1, 0)[:num_objects])
+            new_dict.update(zip([f"{key}{obj}" for obj in range(num_objects)], cols))
         else:
-            new_dict[key] = np.squeeze(var)
+            # keep the event axis even if there is only one event
+            new_dict[key] = var.reshape(-1) if var.size == len(var) else np.squeeze(var)
 
     return new_dict
 
@@ -249,7 +247,7 @@ def run(
         local_parquet_dir = local_dir / "outparquet"
 
         if local_parquet_dir.is_dir():
-            os.system(f"rm -rf {local_parquet_dir}")
+            shutil.rmtree(local_parquet_dir)
 
         local_parquet_dir.mkdir()
 
@@ -291,7 +289,6 @@ def run(
         pickle.dump(out, f)
 
     if save_parquet or save_root:
-        import pandas as pd
         import pyarrow as pa
         import pyarrow.parquet as pq
 
@@ -303,30 +300,42 @@ def run(
         with Path(f"num_batches_{filetag}.txt").open("w") as f:
             f.write(f"{num_batches}")
 
+        batches = [parquet_files[i * batch_size : (i + 1) * batch_size] for i in range(num_batches)]
+
+        def read_batch(batch):
+            # concatenate as arrow tables directly, without a pandas round-trip;
+            # the pandas metadata (multi-index column names) is kept from the input files
+            return pa.concat_tables([pq.read_table(f) for f in batch], promote=True)
+
         # need to combine all the files from these processors before transferring to EOS
         # otherwise it will complain about too many small files
-        for i in range(num_batches):
-            print(i)
-            batch = parquet_files[i * batch_size : (i + 1) * batch_size]
-            print(batch)
-            print([pd.read_parquet(f) for f in batch])
-            pddf = pd.concat([pd.read_parquet(f) for f in batch])
-
-            if save_parquet:
-                # need to write with pyarrow as pd.to_parquet doesn't support different types in
-                # multi-index column names
-                table = pa.Table.from_pandas(pddf)
-                pq.write_table(table, f"{local_dir}/out_{filetag}_batch_{i}.parquet")
-
-            if save_root:
-                import awkward as ak
-
-                with uproot.recreate(
-                    f"{local_dir}/nano_skim_{filetag}_batch_{i}.root", compression=uproot.LZ4(4)
-                ) as rfile:
-                    rfile["Events"] = ak.Array(
-                        # take only top-level column names in multiindex df
-                        flatten_dict(
-                            {key: np.squeeze(pddf[key].values) for key in pddf.columns.levels[0]}
+        # the next batch is read in a background thread while the current one is written
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            next_table = reader.submit(read_batch, batches[0]) if num_batches else None
+            for i, batch in enumerate(batches):
+                print(i)
+                print(batch)
+                table = next_table.result()
+                if i + 1 < num_batches:
+                    next_table = reader.submit(read_batch, batches[i + 1])
+
+                if save_parquet:
+                    pq.write_table(table, f"{local_dir}/out_{filetag}_batch_{i}.parquet")
+
+                if save_root:
+                    import awkward as ak
+
+                    pddf = table.to_pandas()
+
+                    with uproot.recreate(
+                        f"{local_dir}/nano_skim_{filetag}_batch_{i}.root", compression=uproot.LZ4(4)
+                    ) as rfile:
+                        rfile["Events"] = ak.Array(
+                            # take only top-level column names in multiindex df
+                            flatten_dict(
+                                {
+                                    key: np.squeeze(pddf[key].values)
+                                    for key in pddf.columns.levels[0]
+                                }
+                            )
                         )
-                    )
@@ -6,15 +6,27 @@ Author(s): Cristina Mantilla Suarez, Raghav Kansal
 
 from __future__ import annotations
 
+import contextlib
+import json
 import os
+import stat
 import subprocess
 import sys
+import time
 import warnings
+from bisect import bisect_left
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import accumulate
 from math import ceil
+from numbers import Integral
 from pathlib import Path
-from string import Template
+from string import Formatter, Template
+from typing import Iterable, Iterator
 
 from colorama import Fore, Style
+from tqdm import tqdm
 
 from boostedhh import utils
 
@@ -25,19 +37,134 @@ t2_redirectors = {
 
 REPO_DICT = {"bbbb": "HH4b", "bbtautau": "bbtautau"}
 
+# cache of the latest remote commit hashes of analysis branches, and how long (s) they are valid
+BRANCH_CACHE = Path.home() / ".cache" / "boostedhh" / "remote_hashes.json"
+BRANCH_CACHE_TTL = 300
+
+# grid proxies of users on UCSD
+UCSD_PROXIES = {
+    "rkansal": "/home/users/rkansal/x509up_u31735",
+    "dprimosc": "/tmp/x509up_u150012",  # "/home/users/dprimosc/x509up_u150012"
+    "lumori": "/tmp/x509up_u81981",
+}
+
+# rw-r--r-- for the jdls and rwxr-xr-x for the job shell scripts
+FILE_MODE = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
+EXEC_MODE = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
+
 
 def print_red(s):
     return print(f"{Fore.RED}{s}{Style.RESET_ALL}")
 
 
+def _to_format_string(text: str) -> str:
+    """Convert ``string.Template`` syntax (``$var``, ``${var}``, ``$$``) into the equivalent
+    ``str.format`` string, escaping any literal braces"""
+    pieces = []
+    last = 0
+    for match in Template.pattern.finditer(text):
+        pieces.append(text[last : match.start()].replace("{", "{{").replace("}", "}}"))
+        name = match.group("named") or match.group("braced")
+        if name is not None:
+            pieces.append(f"{{{name}}}")
+        elif match.group("escaped") is not None:
+            pieces.append("$")
+        else:
+            raise ValueError(f"Invalid placeholder in template at position {match.start()}")
+
+        last = match.end()
+
+    pieces.append(text[last:].replace("{", "{{").replace("}", "}}"))
+    return "".join(pieces)
+
+
+@lru_cache(maxsize=None)
+def compile_template(templ_file: str) -> str:
+    """Read the template in ``templ_file`` and convert it to a format string, rendered with
+    ``format_map`` (cached, so each file is only read and converted once)"""
+    return _to_format_string(Path(templ_file).read_text())
+
+
+def specialize_template(templ: str, const_args: dict) -> str:
+    """Partially render a format string ``templ`` (from ``compile_template``): fields in
+    ``const_args`` are filled in now, and the rest are kept to be rendered per job, so that each
+    job only has to format its varying arguments."""
+    formatter = Formatter()
+    pieces = []
+    for literal, field, spec, conversion in formatter.parse(templ):
+        pieces.append(literal.replace("{", "{{").replace("}", "}}"))
+        if field is None:
+            continue
+
+        if field in const_args:
+            value = formatter.convert_field(const_args[field], conversion)
+            value = formatter.format_field(value, spec)
+            pieces.append(value.replace("{", "{{").replace("}", "}}"))
+        else:
+            conv_str = f"!{conversion}" if conversion else ""
+            spec_str = f":{spec}" if spec else ""
+            pieces.append(f"{{{field}{conv_str}{spec_str}}}")
+
+    return "".join(pieces)
+
+
+def write_file(out_file: str, data: str, mode: int = FILE_MODE):
+    """Write ``data`` to ``out_file`` with a single unbuffered write. ``mode`` is set when the file
+    is created, so executables don't need a separate chmod."""
+    buf = data.encode()
+    fd = os.open(out_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        while buf:
+            buf = buf[os.write(fd, buf) :]
+    finally:
+        os.close(fd)
+
+
+def write_if_changed(out_file: str, data: str, mode: int = FILE_MODE) -> bool:
+    """Write ``data`` to ``out_file`` (see ``write_file``) unless the file already has exactly this
+    content, so that resubmitting leaves unchanged job files untouched. Returns whether the file
+    was written."""
+    try:
+        if Path(out_file).read_bytes() == data.encode():
+            return False
+    except FileNotFoundError:
+        pass
+
+    write_file(out_file, data, mode)
+    return True
+
+
+def write_rendered(templ: str, out_file: str, templ_args: dict):
+    """Write ``templ`` (from ``compile_template``) rendered with ``templ_args`` to ``out_file``"""
+    write_file(out_file, templ.format_map(templ_args))
+
+
 def write_template(templ_file: str, out_file: str, templ_args: dict):
     """Write to ``out_file`` based on template from ``templ_file`` using ``templ_args``"""
+    write_rendered(compile_template(templ_file), out_file, templ_args)
+
+
+def balance_files(file_sizes: list[int], njobs: int) -> list[tuple[int, int]]:
+    """Split files into ``njobs`` contiguous ``(starti, endi)`` ranges of roughly equal total size.
 
-    with Path(templ_file).open() as f:
-        templ = Template(f.read())
+    Each boundary is placed where the cumulative size is closest to its share of the total, with at
+    least one file per job, so that large files don't all end up in the same (straggler) job.
+    """
+    if njobs == 0:
+        return []
 
-    with Path(out_file).open("w") as f:
-        f.write(templ.substitute(templ_args))
+    cum_sizes = [0, *accumulate(file_sizes)]
+    bounds = [0]
+    for k in range(1, njobs):
+        target = cum_sizes[-1] * k / njobs
+        i = bisect_left(cum_sizes, target)
+        if i > 0 and target - cum_sizes[i - 1] < cum_sizes[i] - target:
+            i -= 1
+
+        bounds.append(min(max(i, bounds[-1] + 1), len(file_sizes) - (njobs - k)))
+
+    bounds.append(len(file_sizes))
+    return list(zip(bounds[:-1], bounds[1:]))
 
 
 def parse_submit_args(parser):
@@ -87,28 +214,83 @@ def parse_submit_args(parser):
         help="Allow the local repo to be different from the specified remote repo (not recommended!)."
         "If false, submit script will exit if the latest commits locally and on Github are different.",
     )
+    utils.add_bool_arg(
+        parser,
+        "branch-cache",
+        default=True,
+        help="reuse the remote branch's commit hash if it was looked up in the last 5 minutes",
+    )
+
+
+def _git(*args: str) -> str:
+    """Output of a git command (run directly, without a shell)"""
+    out = subprocess.run(["git", *args], capture_output=True, text=True, check=False).stdout
+    return out.rstrip("\n")
+
+
+def _remote_hash(git_user: str, repo: str, git_branch: str, local_hash: str | None = None):
+    """Latest commit hash of ``git_branch`` on GitHub, or None if the branch doesn't exist.
+
+    Hashes are cached in ``BRANCH_CACHE`` for ``BRANCH_CACHE_TTL`` seconds, to skip the network
+    round-trip when resubmitting. A cached hash is only used if it matches ``local_hash`` (the
+    cache is ignored if it's None); otherwise GitHub is queried again, so that a stale cache can't
+    cause a spurious mismatch.
+    """
+    key = f"{git_user}/{repo}/{git_branch}"
+    cache = {}
+    # the cache is only an optimisation, so an unreadable or malformed cache is treated as empty
+    with contextlib.suppress(OSError, ValueError):
+        cache = json.loads(BRANCH_CACHE.read_text())
+
+    if not isinstance(cache, dict):
+        cache = {}
+
+    entry = cache.get(key)
+    if (
+        local_hash is not None
+        and isinstance(entry, dict)
+        and entry.get("hash") == local_hash
+        and isinstance(entry.get("time"), (int, float))
+        and time.time() - entry["time"] < BRANCH_CACHE_TTL
+    ):
+        return local_hash
+
+    ref = f"refs/heads/{git_branch}"
+    ls_remote = _git("ls-remote", "--heads", f"https://github.com/{git_user}/{repo}", ref)
+    hashes = [line.split("\t")[0] for line in ls_remote.splitlines() if line.endswith(f"\t{ref}")]
+    if not len(hashes):
+        return None
+
+    cache[key] = {"hash": hashes[0], "time": time.time()}
+    with contextlib.suppress(OSError):
+        BRANCH_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        BRANCH_CACHE.write_text(json.dumps(cache, indent=4))
+
+    return hashes[0]
 
 
 def check_branch(
-    analysis: str, git_branch: str, git_user: str = "LPC-HH", allow_diff_local_repo: bool = False
+    analysis: str,
+    git_branch: str,
+    git_user: str = "LPC-HH",
+    allow_diff_local_repo: bool = False,
+    use_cache: bool = True,
 ):
     """Check that specified git branch exists in the repo, and local repo is up-to-date"""
     repo = REPO_DICT[analysis]
 
-    assert not bool(
-        os.system(
-            f'git ls-remote --exit-code --heads "https://github.com/{git_user}/{repo}" "{git_branch}"'
-        )
-    ), f"Branch {git_branch} does not exist"
+    local_hash = _git("rev-parse", "HEAD")
+    remote_hash = _remote_hash(git_user, repo, git_branch, local_hash if use_cache else None)
+    assert remote_hash is not None, f"Branch {git_branch} does not exist"
 
     print(f"Using branch {git_branch}")
 
     # check if there are uncommitted changes
-    uncommited_files = int(subprocess.getoutput("git status -s | wc -l"))
+    git_status = _git("status", "--porcelain")
 
-    if uncommited_files:
+    if len(git_status):
         print_red("There are local changes that have not been committed!")
-        os.system("git status -s")
+        print(git_status)
         if allow_diff_local_repo:
             print_red("Proceeding anyway...")
         else:
@@ -116,9 +298,6 @@ def check_branch(
             sys.exit(1)
 
     # check that the local repo's latest commit matches that on github
-    remote_hash = subprocess.getoutput(f"git show origin/{git_branch} | head -n 1").split(" ")[1]
-    local_hash = subprocess.getoutput("git rev-parse HEAD")
-
     if remote_hash != local_hash:
         print_red("Latest local and github commits do not match!")
         print(f"Local commit hash: {local_hash}")
@@ -130,9 +309,38 @@ def check_branch(
             sys.exit(1)
 
 
+@lru_cache(maxsize=None)
+def _resolve_proxy(site: str, username: str) -> str:
+    """Path to the user's grid proxy at ``site``"""
+    if site == "lpc":
+        try:
+            return os.environ["X509_USER_PROXY"]
+        except KeyError as e:
+            raise FileNotFoundError("No proxy found on LPC. Exiting.") from e
+    elif site == "ucsd":
+        try:
+            return UCSD_PROXIES[username]
+        except KeyError as e:
+            raise FileNotFoundError(f"No proxy known for user {username} on UCSD. Exiting.") from e
+    else:
+        raise ValueError(f"Invalid site {site}")
+
+
+@lru_cache(maxsize=None)
+def _t2_prefixes(save_sites: tuple[str, ...]) -> tuple[str, ...]:
+    """xrootd redirectors of the sites to save outputs to"""
+    return tuple(t2_redirectors[site] for site in save_sites)
+
+
 def init_args(args):
     # check that branch exists
-    check_branch(args.analysis, args.git_branch, args.git_user, args.allow_diff_local_repo)
+    check_branch(
+        args.analysis,
+        args.git_branch,
+        args.git_user,
+        args.allow_diff_local_repo,
+        args.branch_cache,
+    )
 
     if isinstance(args.year, list):
         if len(args.year) == 1:
@@ -141,28 +349,14 @@ def init_args(args):
             raise ValueError("Submitting multiple years without --yaml option is not supported yet")
 
     username = os.environ["USER"]
-
-    if args.site == "lpc":
-        try:
-            proxy = os.environ["X509_USER_PROXY"]
-        except KeyError as e:
-            raise FileNotFoundError("No proxy found on LPC. Exiting.") from e
-    elif args.site == "ucsd":
-        if username == "rkansal":
-            proxy = "/home/users/rkansal/x509up_u31735"
-        elif username == "dprimosc":
-            proxy = "/tmp/x509up_u150012"  # "/home/users/dprimosc/x509up_u150012"
-        elif username == "lumori":
-            proxy = "/tmp/x509up_u81981"
-    else:
-        raise ValueError(f"Invalid site {args.site}")
+    proxy = _resolve_proxy(args.site, username)
 
     if args.site not in args.save_sites:
         warnings.warn(
             f"Your local site {args.site} is not in save sites {args.save_sites}!", stacklevel=1
         )
 
-    t2_prefixes = [t2_redirectors[site] for site in args.save_sites]
+    t2_prefixes = list(_t2_prefixes(tuple(args.save_sites)))
 
     tag = f"{args.tag}_{args.nano_version}_{args.region}"
 
@@ -181,75 +375,149 @@ def init_args(args):
     return proxy, t2_prefixes, outdir, local_dir
 
 
+def iter_subsamples(fileset: dict | Iterable[tuple]) -> Iterator[tuple]:
+    """Iterate over (sample, subsample, # of files) in ``fileset``, which can be a
+    {sample: {subsample: # of files}} dict or already an iterable of such tuples"""
+    if isinstance(fileset, dict):
+        for sample, sfiles in fileset.items():
+            yield from ((sample, subsample, tot_files) for subsample, tot_files in sfiles.items())
+    else:
+        yield from fileset
+
+
 def submit(
     args,
     proxy,
     t2_prefixes,
     outdir,
     local_dir,
-    fileset: dict,
+    fileset: dict | Iterable[tuple],
     processor_args: str = "",
 ):
-    """Create condor submission files and optionally submit them"""
-    jdl_templ = "boostedhh/condor/submit.templ.jdl"
-    sh_templ = "boostedhh/condor/submit.templ.sh"
-
-    # submit jobs
-    nsubmit = 0
-    for sample, sfiles in fileset.items():
-        for subsample, tot_files in sfiles.items():
-            if args.submit:
-                print("Submitting " + subsample)
-
-            sample_dir = outdir / args.year / subsample
+    """Create condor submission files and optionally submit them
+
+    ``fileset`` is {sample: {subsample: # of files}}, or an iterable (e.g. a generator) of
+    (sample, subsample, # of files) tuples (see ``iter_subsamples``). The number of files can
+    instead be a list of the files' sizes, in which case the files are split into jobs of roughly
+    equal total size (see ``balance_files``) rather than ``args.files_per_job`` files each.
+
+    The arguments and fileset are checked, and all jobs planned, before any files are written.
+    """
+    for attr in ["year", "processor", "nano_version"]:
+        if not isinstance(getattr(args, attr, None), str) or not getattr(args, attr):
+            raise ValueError(f"Invalid {attr} {getattr(args, attr, None)!r}")
+
+    if args.files_per_job < 1:
+        raise ValueError(f"Invalid files per job {args.files_per_job}")
+
+    # (sample, subsample, [(starti, endi) per job])
+    plan = []
+    for entry in iter_subsamples(fileset):
+        if len(entry) != 3:
+            raise ValueError(f"Invalid fileset entry {entry!r}")
+
+        sample, subsample, tot_files = entry
+        if isinstance(tot_files, Integral) and not isinstance(tot_files, bool):
             njobs = ceil(tot_files / args.files_per_job)
-
-            for j in range(njobs):
-                if args.test and j == 2:
-                    break
-
-                prefix = f"{args.year}_{subsample}"
-                localcondor = f"{local_dir}/{prefix}_{j}.jdl"
-                jdl_args = {"dir": local_dir, "prefix": prefix, "jobid": j, "proxy": proxy}
-                write_template(jdl_templ, localcondor, jdl_args)
-
-                localsh = f"{local_dir}/{prefix}_{j}.sh"
-                sh_args = {
-                    "repo": REPO_DICT[args.analysis],
-                    "branch": args.git_branch,
-                    "gituser": args.git_user,
-                    "script": args.script,
-                    "year": args.year,
-                    "starti": j * args.files_per_job,
-                    "endi": (j + 1) * args.files_per_job,
-                    "batch_size": args.batch_size,
-                    "sample": sample,
-                    "subsample": subsample,
-                    "processor": args.processor,
-                    "maxchunks": args.maxchunks,
-                    "chunksize": args.chunksize,
-                    "t2_prefixes": " ".join(t2_prefixes),
-                    "outdir": sample_dir,
-                    "filetag": j,
-                    "jobnum": j,
-                    "save_root": ("--save-root" if args.save_root else "--no-save-root"),
-                    "nano_version": args.nano_version,
-                    "save_systematics": (
-                        "--save-systematics" if args.save_systematics else "--no-save-systematics"
-                    ),
-                    "processor_args": processor_args,
-                }
-                write_template(sh_templ, localsh, sh_args)
-                os.system(f"chmod u+x {localsh}")
-
-                if Path(f"{localcondor}.log").exists():
-                    Path(f"{localcondor}.log").unlink()
-
-                if args.submit:
-                    os.system(f"condor_submit {localcondor}")
-                else:
-                    print("To submit ", localcondor)
-                nsubmit = nsubmit + 1
+            effective_njobs = min(2, njobs) if args.test else njobs
+            ranges = [
+                (j * args.files_per_job, (j + 1) * args.files_per_job)
+                for j in range(effective_njobs)
+            ]
+        elif isinstance(tot_files, (list, tuple)):
+            # list of file sizes: balance the total size per job
+            njobs = ceil(len(tot_files) / args.files_per_job)
+            effective_njobs = min(2, njobs) if args.test else njobs
+            ranges = balance_files(tot_files, njobs)[:effective_njobs]
+        else:
+            raise ValueError(f"Invalid # of files {tot_files!r} for subsample {subsample}")
+
+        plan.append((sample, subsample, ranges))
+
+    nsubmit = sum(len(ranges) for _, _, ranges in plan)
+
+    jdl_templ = compile_template("boostedhh/condor/submit.templ.jdl")
+    sh_templ = compile_template("boostedhh/condor/submit.templ.sh")
+
+    # shell script arguments which are the same for every job
+    base_sh_args = {
+        "repo": REPO_DICT[args.analysis],
+        "branch": args.git_branch,
+        "gituser": args.git_user,
+        "script": args.script,
+        "year": args.year,
+        "batch_size": args.batch_size,
+        "processor": args.processor,
+        "maxchunks": args.maxchunks,
+        "chunksize": args.chunksize,
+        "t2_prefixes": " ".join(t2_prefixes),
+        "save_root": ("--save-root" if args.save_root else "--no-save-root"),
+        "nano_version": args.nano_version,
+        "save_systematics": (
+            "--save-systematics" if args.save_systematics else "--no-save-systematics"
+        ),
+        "processor_args": processor_args,
+    }
+
+    # fill in everything but the per-subsample and per-job arguments once
+    jdl_templ = specialize_template(jdl_templ, {"dir": local_dir, "proxy": proxy})
+    sh_templ = specialize_template(sh_templ, base_sh_args)
+
+    def emit_job(subsample: str, j: int, starti: int, endi: int):
+        """Write the jdl for job ``j`` of ``subsample``"""
+        prefix = f"{args.year}_{subsample}"
+        localcondor = Path(f"{local_dir}/{prefix}_{j}.jdl")
+        jdl = jdl_templ.format(prefix=prefix, jobid=j, starti=starti, endi=endi)
+        write_if_changed(localcondor, jdl)
+
+        Path(f"{localcondor}.log").unlink(missing_ok=True)
+
+        return localcondor, jdl
+
+    jobs = []
+    outdir_year = outdir / args.year
+    for sample, subsample, ranges in plan:
+        if args.submit:
+            print("Submitting " + subsample)
+
+        if not len(ranges):
+            continue
+
+        sample_dir = outdir_year / subsample
+
+        # one shell script per subsample, which takes the job number and file range as arguments
+        localsh = f"{local_dir}/{args.year}_{subsample}.sh"
+        sh = sh_templ.format(sample=sample, subsample=subsample, outdir=sample_dir)
+        write_if_changed(localsh, sh, EXEC_MODE)
+
+        jobs += [(subsample, j, starti, endi) for j, (starti, endi) in enumerate(ranges)]
+
+    # jobs are independent, so their jdls are written in parallel to overlap filesystem latency
+    pending_jdls = defaultdict(list)
+    written_jdls = []
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        results = executor.map(lambda job: emit_job(*job), jobs)
+        for job, (localcondor, jdl) in tqdm(zip(jobs, results), total=nsubmit, desc="Writing jobs"):
+            if args.submit:
+                pending_jdls[job[0]].append(jdl)
+            else:
+                written_jdls.append(localcondor)
+
+    # printed after the progress bar has finished, so they aren't interleaved with it
+    for localcondor in written_jdls:
+        print("To submit ", localcondor)
+
+    # a subsample's jobs all share its executable, so each subsample is submitted as one cluster
+    # (.sub so that it isn't picked up as a job's .jdl by check_jobs.py)
+    failed = []
+    for subsample, jdls in pending_jdls.items():
+        sub_file = Path(f"{local_dir}/{args.year}_{subsample}.sub")
+        write_file(sub_file, "\n".join(jdls))
+        if subprocess.run(["condor_submit", str(sub_file)], check=False).returncode:
+            failed.append(subsample)
+
+    if failed:
+        print_red(f"condor_submit failed for subsamples {failed}")
 
     print(f"Total {nsubmit} jobs")
 
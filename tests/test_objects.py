@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import awkward as ak
+import numpy as np
+import pytest
+
+from boostedhh.processors.objects import JETID_KERNEL_MIN_JETS, _jetid_v12_ak, jetid_v12
+
+
+def _jetid_v12_reference(jets: ak.Array) -> ak.Array:
+    """Original, unfused jet ID expression"""
+    jetidtightbit = (jets.jetId & 2) == 2
+    jetidtight = (
+        ((np.abs(jets.eta) <= 2.7) & jetidtightbit)
+        | (
+            ((np.abs(jets.eta) > 2.7) & (np.abs(jets.eta) <= 3.0))
+            & jetidtightbit
+            & (jets.neHEF >= 0.99)
+        )
+        | ((np.abs(jets.eta) > 3.0) & jetidtightbit & (jets.neEmEF < 0.4))
+    )
+
+    jetidtightlepveto = (
+        (np.abs(jets.eta) <= 2.7) & jetidtight & (jets.muEF < 0.8) & (jets.chEmEF < 0.8)
+    ) | ((np.abs(jets.eta) > 2.7) & jetidtight)
+
+    return jetidtight, jetidtightlepveto
+
+
+def _random_jets(nevents: int) -> ak.Array:
+    rng = np.random.default_rng(42)
+    counts = rng.integers(0, 5, nevents)
+    njets = int(counts.sum())
+    jets = ak.zip(
+        {
+            "eta": rng.uniform(-5, 5, njets),
+            "jetId": rng.integers(0, 7, njets).astype(np.int32),
+            "neHEF": rng.uniform(0.95, 1, njets),
+            "neEmEF": rng.uniform(0, 1, njets),
+            "muEF": rng.uniform(0, 1, njets),
+            "chEmEF": rng.uniform(0, 1, njets),
+        }
+    )
+    return ak.unflatten(jets, counts)
+
+
+@pytest.mark.parametrize("pad", [False, True])
+@pytest.mark.parametrize("nevents", [100, JETID_KERNEL_MIN_JETS * 2])
+def test_jetid_v12(nevents, pad):
+    jets = _random_jets(nevents)
+    if pad:
+        jets = ak.pad_none(jets, 3, axis=1)
+
+    expected = [ak.to_list(mask) for mask in _jetid_v12_reference(jets)]
+    assert [ak.to_list(mask) for mask in _jetid_v12_ak(jets)] == expected
+    assert [ak.to_list(mask) for mask in jetid_v12(jets)] == expected
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+from pathlib import Path
+from string import Template
+
+import pytest
+
+from boostedhh.submit_utils import balance_files, compile_template, specialize_template
+
+CONDOR_DIR = Path(__file__).parent.parent / "condor"
+
+
+@pytest.mark.parametrize("templ_file", ["submit.templ.jdl", "submit.templ.sh"])
+def test_compile_template(templ_file):
+    templ_path = CONDOR_DIR / templ_file
+    text = templ_path.read_text()
+
+    names = {m.group("named") or m.group("braced") for m in Template.pattern.finditer(text)}
+    templ_args = {name: f"<{name}>" for name in names if name is not None}
+
+    assert compile_template(str(templ_path)).format_map(templ_args) == Template(text).substitute(
+        templ_args
+    )
+
+
+def test_specialize_template():
+    templ = compile_template(str(CONDOR_DIR / "submit.templ.jdl"))
+    templ_args = {
+        "dir": "condor/test",
+        "prefix": "2022_HH",
+        "jobid": 3,
+        "starti": 30,
+        "endi": 40,
+        "proxy": "/tmp/x509up",
+    }
+    const_args = {"dir": templ_args["dir"], "proxy": templ_args["proxy"]}
+
+    assert specialize_template(templ, const_args).format_map(templ_args) == templ.format_map(
+        templ_args
+    )
+
+
+@pytest.mark.parametrize(
+    ("file_sizes", "njobs", "expected"),
+    [
+        ([], 0, []),
+        ([1] * 6, 3, [(0, 2), (2, 4), (4, 6)]),
+        ([1] * 3, 3, [(0, 1), (1, 2), (2, 3)]),
+        ([10, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], 2, [(0, 1), (1, 11)]),
+        ([1, 1, 1, 1, 100], 2, [(0, 4), (4, 5)]),
+        ([100, 100, 1], 3, [(0, 1), (1, 2), (2, 3)]),
+    ],
+)
+def test_balance_files(file_sizes, njobs, expected):
+    assert balance_files(file_sizes, njobs) == expected
+
+
+@pytest.mark.parametrize("njobs", [1, 2, 7, 20])
+def test_balance_files_ranges(njobs):
+    file_sizes = [(i * 37) % 11 + 1 for i in range(20)]
+    ranges = balance_files(file_sizes, njobs)
+
+    assert len(ranges) == njobs
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == len(file_sizes)
+    assert all(starti < endi for starti, endi in ranges)
+    assert all(ranges[k][1] == ranges[k + 1][0] for k in range(njobs - 1))